@@ -5,8 +5,10 @@ import os
 
 import genshi
 import genshi.template
-from sql import Literal
+from sql import Column, Literal, Null
+from sql.aggregate import Count
 
+from trytond import backend
 from trytond.pool import PoolMeta, Pool
 from trytond.model import ModelSQL, ModelView, Workflow, fields
 from trytond.pyson import Eval, If
@@ -16,6 +18,13 @@ from trytond.tools import reduce_ids
 __metaclass__ = PoolMeta
 __all__ = ['Journal', 'Group', 'Payment', 'Mandate']
 
+_SEPA_METHOD_MAP = {
+    'sepa_core': 'CORE',
+    'sepa_b2b': 'B2B',
+    'sepa_trf': 'TRF',
+    'sepa_chk': 'CHK',
+    }
+
 
 class Journal:
     __name__ = 'account.payment.journal'
@@ -73,9 +82,15 @@ class Journal:
     def default_company_party(cls):
         pool = Pool()
         Company = pool.get('company.company')
+        company = Company.__table__
+        cursor = Transaction().cursor
         company_id = cls.default_company()
         if company_id:
-            return Company(company_id).party.id
+            cursor.execute(*company.select(company.party,
+                    where=company.id == company_id))
+            row = cursor.fetchone()
+            if row:
+                return row[0]
 
     def on_change_with_company_party(self, name=None):
         if self.company:
@@ -83,33 +98,28 @@ class Journal:
 
     @property
     def sepa_method(self):
-        if self.process_method == "sepa_core":
-            return "CORE"
-        elif self.process_method == "sepa_b2b":
-            return "B2B"
-        elif self.process_method == "sepa_trf":
-            return "TRF"
-        elif self.process_method == "sepa_chk":
-            return "CHK"
-        else:
-            return ""
+        return _SEPA_METHOD_MAP.get(self.process_method, "")
 
 
 def remove_comment(stream):
     for kind, data, pos in stream:
         if kind is genshi.core.COMMENT:
             continue
+        elif kind is genshi.template.base.SUB:
+            directives, substream = data
+            data = directives, list(remove_comment(substream))
         yield kind, data, pos
 
 
 loader = genshi.template.TemplateLoader(
     os.path.join(os.path.dirname(__file__), 'template'),
-    auto_reload=True)
+    auto_reload=bool(os.environ.get('TRYTOND_DEV')))
+_TEMPLATE_CACHE = {}
 
 
 class Group:
     __name__ = 'account.payment.group'
-    sepa_message = fields.Text('SEPA Message', readonly=True, states={
+    sepa_message = fields.Binary('SEPA Message', readonly=True, states={
             'invisible': ~Eval('sepa_message'),
             })
     sepa_file = fields.Function(fields.Binary('SEPA File',
@@ -126,9 +136,53 @@ class Group:
                 'no_mandate': 'No valid mandate for payment "%s"',
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Model = pool.get('ir.model')
+        ModelField = pool.get('ir.model.field')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        model = Model.__table__
+        model_field = ModelField.__table__
+        sql_table = cls.__table__
+        table = TableHandler(cursor, cls, module_name)
+
+        # Migration: sepa_message changed from Text to Binary during 3.2
+        cursor.execute(*model_field.join(model,
+                condition=model_field.model == model.id
+                ).select(model_field.ttype,
+                where=(model.model == cls.__name__)
+                & (model_field.name == 'sepa_message')))
+        row = cursor.fetchone()
+        if row and row[0] == 'text':
+            table.column_rename('sepa_message', 'sepa_message_text')
+
+        super(Group, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        if table.column_exist('sepa_message_text'):
+            message_text = Column(sql_table, 'sepa_message_text')
+            cursor.execute(*sql_table.select(sql_table.id,
+                    where=message_text != Null))
+            group_ids = [i for i, in cursor.fetchall()]
+            in_max = cursor.IN_MAX
+            for i in range(0, len(group_ids), in_max):
+                sub_ids = group_ids[i:i + in_max]
+                cursor.execute(*sql_table.select(sql_table.id, message_text,
+                        where=reduce_ids(sql_table.id, sub_ids)))
+                for group_id, message in cursor.fetchall():
+                    if isinstance(message, unicode):
+                        message = message.encode('utf-8')
+                    cursor.execute(*sql_table.update(
+                            columns=[sql_table.sepa_message],
+                            values=[buffer(message)],
+                            where=sql_table.id == group_id))
+            table.drop_column('sepa_message_text')
+
     def get_sepa_file(self, name):
         if self.sepa_message:
-            return buffer(self.sepa_message.encode('utf-8'))
+            return self.sepa_message
         else:
             return ""
 
@@ -137,9 +191,19 @@ class Group:
 
     def get_sepa_template(self):
         if self.kind == 'payable':
-            return loader.load('%s.xml' % self.journal.sepa_payable_flavor)
+            flavor = self.journal.sepa_payable_flavor
         elif self.kind == 'receivable':
-            return loader.load('%s.xml' % self.journal.sepa_receivable_flavor)
+            flavor = self.journal.sepa_receivable_flavor
+        else:
+            return
+        tmpl = _TEMPLATE_CACHE.get(flavor)
+        if tmpl is None or loader.auto_reload:
+            tmpl = loader.load('%s.xml' % flavor)
+            # Strip comments once from the compiled stream instead of
+            # filtering them out on each rendering
+            tmpl.stream[:] = remove_comment(tmpl.stream)
+            _TEMPLATE_CACHE[flavor] = tmpl
+        return tmpl
 
     def process_sepa_core(self):
         self.process_sepa()
@@ -158,29 +222,40 @@ class Group:
         Payment = pool.get('account.payment')
         if self.kind == 'receivable':
             payments = [p for p in self.payments if not p.sepa_mandate]
-            mandates = Payment.get_sepa_mandates(payments)
-            for payment, mandate in zip(payments, mandates):
-                if not mandate:
-                    self.raise_user_error('no_mandate', payment.rec_name)
-                Payment.write([payment], {
-                        'sepa_mandate': mandate,
-                        })
+            if payments:
+                mandates = Payment.get_sepa_mandates(payments)
+                missing = [p for p, m in zip(payments, mandates) if not m]
+                if missing:
+                    self.raise_user_error('no_mandate', missing[0].rec_name)
+                mandate_payments = {}
+                for payment, mandate in zip(payments, mandates):
+                    mandate_payments.setdefault(mandate, []).append(payment)
+                for mandate, to_write in mandate_payments.iteritems():
+                    Payment.write(to_write, {
+                            'sepa_mandate': mandate,
+                            })
         tmpl = self.get_sepa_template()
         if not tmpl:
             raise NotImplementedError
-        self.sepa_message = tmpl.generate(group=self,
-            datetime=datetime).filter(remove_comment).render()
+        stream = tmpl.generate(group=self, datetime=datetime)
+        if loader.auto_reload:
+            # Included templates are only inlined, and so stripped, when the
+            # loader does not auto reload
+            stream = stream.filter(remove_comment)
+        self.sepa_message = buffer(stream.render(encoding='utf-8'))
 
     @property
     def sepa_initiating_party(self):
-        return self.company.party
+        if '_sepa_initiating_party' not in self.__dict__:
+            self._sepa_initiating_party = self.company.party
+        return self._sepa_initiating_party
 
 
 class Payment:
     __name__ = 'account.payment'
 
     sepa_mandate = fields.Many2One('account.payment.sepa.mandate', 'Mandate',
-        ondelete='RESTRICT',
+        ondelete='RESTRICT', select=True,
         domain=[
             ('party', '=', Eval('party', -1)),
             ],
@@ -188,9 +263,27 @@ class Payment:
 
     @classmethod
     def get_sepa_mandates(cls, payments):
+        pool = Pool()
+        Mandate = pool.get('account.payment.sepa.mandate')
+        party_ids = list(set(p.party.id for p in payments))
+        all_mandates = Mandate.search([
+                ('party', 'in', party_ids),
+                ('state', '=', 'validated'),
+                ])
+        # Prefetch has_payments used by is_valid in a single query, it is only
+        # read for one-off mandates
+        oneoff_mandates = [m for m in all_mandates if m.type == 'one-off']
+        has_payments = Mandate.get_has_payments(oneoff_mandates,
+            'has_payments')
+        for mandate in oneoff_mandates:
+            mandate.has_payments = has_payments[mandate.id]
+        party_mandates = {}
+        for mandate in all_mandates:
+            party_mandates.setdefault(mandate.party.id, []).append(mandate)
+
         mandates = []
         for payment in payments:
-            for mandate in payment.party.sepa_mandates:
+            for mandate in party_mandates.get(payment.party.id, []):
                 if mandate.is_valid:
                     break
             else:
@@ -276,7 +369,9 @@ class Mandate(Workflow, ModelSQL, ModelView):
             ], 'State', readonly=True)
     payments = fields.One2Many('account.payment', 'sepa_mandate', 'Payments')
     has_payments = fields.Function(fields.Boolean('Has Payments'),
-        'has_payments')
+        'get_has_payments')
+    payment_count = fields.Function(fields.Integer('Payment Count'),
+        'get_payment_count')
 
     @classmethod
     def __setup__(cls):
@@ -308,6 +403,16 @@ class Mandate(Workflow, ModelSQL, ModelView):
                     'because it is not in draft or canceled state.'),
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(Mandate, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['party', 'state'], 'add')
+
     @staticmethod
     def default_company():
         return Transaction().context.get('company')
@@ -337,30 +442,58 @@ class Mandate(Workflow, ModelSQL, ModelView):
     def sequence_type(self):
         if self.type == 'one-off':
             return 'OOFF'
-        elif len(self.payments) == 1:
+        elif self.payment_count == 1:
             return 'FRST'
         # TODO manage FNAL
         else:
             return 'RCUR'
 
+    @staticmethod
+    def _payment_mandate_where(column, mandates):
+        cursor = Transaction().cursor
+        if backend.name() == 'postgresql':
+            # PostgreSQL has no limit on the number of parameters so all the
+            # mandates are checked in a single query
+            in_max = max(len(mandates), 1)
+        else:
+            in_max = cursor.IN_MAX
+        for i in range(0, len(mandates), in_max):
+            sub_ids = [m.id for m in mandates[i:i + in_max]]
+            yield reduce_ids(column, sub_ids)
+
     @classmethod
-    def has_payments(self, mandates, name):
+    def get_has_payments(cls, mandates, name):
         pool = Pool()
         Payment = pool.get('account.payment')
         payment = Payment.__table__
         cursor = Transaction().cursor
-        in_max = cursor.IN_MAX
 
-        has_payments = dict.fromkeys([m.id for m in mandates], False)
-        for i in range(0, len(mandates), in_max):
-            sub_ids = [i.id for i in mandates[i:i + in_max]]
-            red_sql = reduce_ids(payment.sepa_mandate, sub_ids)
-            cursor.execute(*payment.select(payment.sepa_mandate, Literal(True),
+        has_payments = {m.id: False for m in mandates}
+        for red_sql in cls._payment_mandate_where(payment.sepa_mandate,
+                mandates):
+            cursor.execute(*payment.select(payment.sepa_mandate,
                     where=red_sql,
-                    group_by=payment.sepa_mandate))
-            has_payments.update(cursor.fetchall())
+                    distinct=True))
+            has_payments.update((mandate_id, True)
+                for mandate_id, in cursor.fetchall())
+        return has_payments
 
-        return {'has_payments': has_payments}
+    @classmethod
+    def get_payment_count(cls, mandates, name):
+        pool = Pool()
+        Payment = pool.get('account.payment')
+        payment = Payment.__table__
+        cursor = Transaction().cursor
+
+        payment_count = {m.id: 0 for m in mandates}
+        for red_sql in cls._payment_mandate_where(payment.sepa_mandate,
+                mandates):
+            cursor.execute(*payment.select(payment.sepa_mandate,
+                    Count(Literal(1)),
+                    where=red_sql,
+                    group_by=payment.sepa_mandate))
+            payment_count.update(cursor.fetchall())
+        return payment_count
 
     @classmethod
     @ModelView.button
@@ -15,6 +15,7 @@ import trytond.tests.test_tryton
 from trytond.tests.test_tryton import test_view, test_depends
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 
 
 class AccountPaymentSepaTestCase(unittest.TestCase):
@@ -45,83 +46,118 @@ class AccountPaymentSepaTestCase(unittest.TestCase):
         'Test depends'
         test_depends()
 
-    def validate_file(self, flavor, kind, process_method):
-        'Test generated files are valid'
-        with Transaction().start(DB_NAME, USER, context=CONTEXT):
-            company, = self.company.search([
-                    ('rec_name', '=', 'Dunder Mifflin'),
-                    ])
-            euro, = self.currency.create([{
-                        'name': 'Euro',
-                        'symbol': 'EUR',
-                        'code': 'EUR',
-                        }])
-            company.currency = euro
-            company.party.sepa_creditor_identifier = 'ES75ZZZ00000000T'
-            company.party.save()
-            company.save()
-            bank_party = self.party(name='European Bank')
-            bank_party.save()
-            bank = self.bank(party=bank_party, bic='BICODEBBXXX')
-            bank.save()
-            customer = self.party(name='Customer',
-                sepa_creditor_identifier='ES48ZZZ00000001R')
-            customer.save()
-            company_account, customer_account = self.bank_account.create([{
-                        'bank': bank,
-                        'owners': [('add', [company.party])],
-                        'numbers': [('create', [{
-                                        'type': 'iban',
-                                        'number': 'ES8200000000000000000000',
-                                        }])]}, {
+    def setup_company(self):
+        'Setup the company with its SEPA bank account'
+        company, = self.company.search([
+                ('rec_name', '=', 'Dunder Mifflin'),
+                ])
+        euro, = self.currency.create([{
+                    'name': 'Euro',
+                    'symbol': 'EUR',
+                    'code': 'EUR',
+                    }])
+        company.currency = euro
+        company.party.sepa_creditor_identifier = 'ES75ZZZ00000000T'
+        company.party.save()
+        company.save()
+        bank_party = self.party(name='European Bank')
+        bank_party.save()
+        bank = self.bank(party=bank_party, bic='BICODEBBXXX')
+        bank.save()
+        company_account, = self.bank_account.create([{
+                    'bank': bank,
+                    'owners': [('add', [company.party])],
+                    'numbers': [('create', [{
+                                    'type': 'iban',
+                                    'number': 'ES8200000000000000000000',
+                                    }])]}])
+        company_bank_number, = company_account.numbers
+        return company, bank, company_bank_number
+
+    def create_customer(self, bank, ibans):
+        'Create a customer with one bank account per IBAN'
+        customer = self.party(name='Customer',
+            sepa_creditor_identifier='ES48ZZZ00000001R')
+        customer.save()
+        accounts = []
+        for iban in ibans:
+            account, = self.bank_account.create([{
                         'bank': bank,
                         'owners': [('add', [customer])],
                         'numbers': [('create', [{
                                         'type': 'iban',
-                                        'number': 'ES3600000000050000000001',
+                                        'number': iban,
                                         }])]}])
-            self.mandate.create([{
-                        'company': company,
-                        'party': customer,
-                        'account_number': customer_account,
-                        'identification': 'MANDATE',
-                        'type': 'recurrent',
-                        'signature_date': self.date.today(),
-                        'state': 'validated',
-                        }])
-
-            company_bank_number, = company_account.numbers
-            journal = self.payment_journal()
-            journal.name = flavor
-            journal.company = company
-            journal.currency = company.currency
-            journal.process_method = process_method
-            journal.sepa_bank_account_number = company_bank_number
-            setattr(journal, 'sepa_%s_flavor' % kind, flavor)
-            journal.save()
-
-            payment, = self.payment.create([{
-                        'company': company,
-                        'party': customer,
-                        'journal': journal,
-                        'kind': kind,
-                        'amount': Decimal('1000.0'),
-                        'state': 'approved',
-                        'description': 'PAYMENT',
-                        'date': self.date.today(),
-                        }])
-
-            session_id, _, _ = self.process_payment.create()
-            process_payment = self.process_payment(session_id)
-            with Transaction().set_context(active_ids=[payment.id]):
-                _, data = process_payment.do_process(None)
-            group, = self.payment_group.browse(data['res_id'])
-            sepa_string = group.sepa_message.encode('utf-8')
-            sepa_file = etree.fromstring(sepa_string)
+            accounts.append(account)
+        return customer, accounts
+
+    def create_mandate(self, company, customer, account, type_='recurrent'):
+        'Create a validated mandate'
+        account_number, = account.numbers
+        mandate, = self.mandate.create([{
+                    'company': company,
+                    'party': customer,
+                    'account_number': account_number,
+                    'identification': 'MANDATE',
+                    'type': type_,
+                    'signature_date': self.date.today(),
+                    'state': 'validated',
+                    }])
+        return mandate
+
+    def create_journal(self, company, bank_number, flavor, kind,
+            process_method):
+        'Create a SEPA payment journal'
+        journal = self.payment_journal()
+        journal.name = flavor
+        journal.company = company
+        journal.currency = company.currency
+        journal.process_method = process_method
+        journal.sepa_bank_account_number = bank_number
+        setattr(journal, 'sepa_%s_flavor' % kind, flavor)
+        journal.save()
+        return journal
+
+    def create_payment(self, company, customer, journal, kind):
+        'Create an approved payment'
+        payment, = self.payment.create([{
+                    'company': company,
+                    'party': customer,
+                    'journal': journal,
+                    'kind': kind,
+                    'amount': Decimal('1000.0'),
+                    'state': 'approved',
+                    'description': 'PAYMENT',
+                    'date': self.date.today(),
+                    }])
+        return payment
+
+    def process_payments(self, payments):
+        'Process the payments and return the SEPA file of the group'
+        session_id, _, _ = self.process_payment.create()
+        process_payment = self.process_payment(session_id)
+        with Transaction().set_context(active_ids=[p.id for p in payments]):
+            _, data = process_payment.do_process(None)
+        group, = self.payment_group.browse(data['res_id'])
+        return etree.fromstring(str(group.sepa_message))
+
+    def validate_file(self, flavor, kind, process_method):
+        'Test generated files are valid'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company, bank, company_bank_number = self.setup_company()
+            customer, (customer_account,) = self.create_customer(bank,
+                ['ES3600000000050000000001'])
+            self.create_mandate(company, customer, customer_account)
+            journal = self.create_journal(company, company_bank_number,
+                flavor, kind, process_method)
+            payment = self.create_payment(company, customer, journal, kind)
+
+            sepa_file = self.process_payments([payment])
             schema_file = os.path.join(os.path.dirname(__file__),
                 '%s.xsd' % flavor)
             schema = etree.XMLSchema(etree.parse(schema_file))
             schema.assertValid(sepa_file)
+            self.assertEqual(sepa_file.xpath('//comment()'), [])
 
     def test_pain001_001_03(self):
         'Test pain001.001.03 xsd validation'
@@ -139,6 +175,87 @@ class AccountPaymentSepaTestCase(unittest.TestCase):
         'Test pain008.001.04 xsd validation'
         self.validate_file('pain.008.001.04', 'receivable', 'sepa_core')
 
+    def test_one_off_mandate(self):
+        'Test one-off mandate is only used for one payment'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company, bank, company_bank_number = self.setup_company()
+            customer, (customer_account,) = self.create_customer(bank,
+                ['ES3600000000050000000001'])
+            mandate = self.create_mandate(company, customer, customer_account,
+                'one-off')
+            journal = self.create_journal(company, company_bank_number,
+                'pain.008.001.02', 'receivable', 'sepa_core')
+
+            payment = self.create_payment(company, customer, journal,
+                'receivable')
+            self.process_payments([payment])
+            payment = self.payment(payment.id)
+            self.assertEqual(payment.sepa_mandate, mandate)
+
+            payment = self.create_payment(company, customer, journal,
+                'receivable')
+            self.assertRaises(UserError, self.process_payments, [payment])
+
+    def test_sequence_type(self):
+        'Test sequence type of recurrent mandate payments'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company, bank, company_bank_number = self.setup_company()
+            customer, (customer_account,) = self.create_customer(bank,
+                ['ES3600000000050000000001'])
+            self.create_mandate(company, customer, customer_account)
+            journal = self.create_journal(company, company_bank_number,
+                'pain.008.001.02', 'receivable', 'sepa_core')
+            namespaces = {
+                'ns': 'urn:iso:std:iso:20022:tech:xsd:pain.008.001.02',
+                }
+
+            for sequence_type in ['FRST', 'RCUR']:
+                payment = self.create_payment(company, customer, journal,
+                    'receivable')
+                sepa_file = self.process_payments([payment])
+                self.assertEqual(
+                    sepa_file.xpath('//ns:SeqTp/text()',
+                        namespaces=namespaces),
+                    [sequence_type])
+
+    def test_debtor_iban(self):
+        'Test debtor IBAN is the first of the party bank accounts'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            company, bank, company_bank_number = self.setup_company()
+            customer, _ = self.create_customer(bank, [])
+            # The first account gets its IBAN number after the second one so
+            # the number order differs from the account order
+            first_account, _ = self.bank_account.create([{
+                        'bank': bank,
+                        'owners': [('add', [customer])],
+                        }, {
+                        'bank': bank,
+                        'owners': [('add', [customer])],
+                        'numbers': [('create', [{
+                                        'type': 'iban',
+                                        'number': 'ES6300000000010000000002',
+                                        }])]}])
+            self.bank_account.write([first_account], {
+                    'numbers': [('create', [{
+                                    'type': 'iban',
+                                    'number': 'ES3600000000050000000001',
+                                    }])]})
+            first_account = self.bank_account(first_account.id)
+            self.create_mandate(company, customer, first_account)
+            journal = self.create_journal(company, company_bank_number,
+                'pain.008.001.02', 'receivable', 'sepa_core')
+            payment = self.create_payment(company, customer, journal,
+                'receivable')
+            namespaces = {
+                'ns': 'urn:iso:std:iso:20022:tech:xsd:pain.008.001.02',
+                }
+
+            sepa_file = self.process_payments([payment])
+            self.assertEqual(
+                sepa_file.xpath('//ns:DbtrAcct/ns:Id/ns:IBAN/text()',
+                    namespaces=namespaces),
+                ['ES3600000000050000000001'])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()